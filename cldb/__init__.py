@@ -1,14 +1,22 @@
+import functools
 import pathlib
 from typing import Callable, Union
 
-import click
-
 __version__ = "21.5.16"
 
 APP_NAME = "cldb"
 
-app_dir = pathlib.Path(click.get_app_dir(APP_NAME, roaming=False, force_posix=True))
-cache_root = app_dir / "cache"
+
+@functools.lru_cache(maxsize=None)
+def get_app_dir() -> pathlib.Path:
+    import click
+
+    return pathlib.Path(click.get_app_dir(APP_NAME, roaming=False, force_posix=True))
+
+
+def get_cache_root() -> pathlib.Path:
+    return get_app_dir() / "cache"
+
 
 config = {
     "bs_features": "lxml",
@@ -1,7 +1,11 @@
 """Command to control download cache."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
 import click
 
-from .. import cache_root
+from .. import get_cache_root
 from . import main
 
 
@@ -14,7 +18,7 @@ def cache() -> None:
 @cache.command()
 def info() -> None:
     """Show information about the cache."""
-    click.echo(cache_root.absolute())
+    click.echo(get_cache_root().absolute())
 
 
 @cache.command()
@@ -22,12 +26,27 @@ def info() -> None:
 def purge(verbose: bool) -> None:
     """Remove cache data."""
 
+    cache_root = get_cache_root()
     if cache_root.exists():
-        for path in cache_root.glob("**/*"):
-            try:
+        paths = [
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(os.path.abspath(cache_root))
+            for filename in filenames
+        ]
+
+        # Unlinking is I/O bound, so remove files on several threads
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for path, error in zip(paths, executor.map(_remove, paths)):
                 if verbose:
-                    click.secho(str(path.absolute()), dim=True)
-                path.unlink()
-            except OSError as ex:
-                msg = f"cannot remove '{path}': {str(ex)}"
-                click.secho(msg, fg="yellow")
+                    click.secho(path, dim=True)
+                if error is not None:
+                    msg = f"cannot remove '{path}': {error}"
+                    click.secho(msg, fg="yellow")
+
+
+def _remove(path: str) -> Optional[str]:
+    try:
+        os.unlink(path)
+    except OSError as ex:
+        return str(ex)
+    return None
@@ -1,27 +1,52 @@
 """Command to fetch internet resources."""
+import csv
 import io
 import itertools
+import json
 import logging
 import multiprocessing
+import os
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from functools import partial
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    Type,
+    Union,
+)
 
 import click
-import pandas as pd
-from joblib.parallel import delayed
 
-from .. import models, nikon, sony, utils
+from .. import SpecFetcher
 from . import main
 
 _logger = logging.getLogger(__name__)
+_default_num_threads = 32
 _help_num_workers = (
-    "Number of worker processes to launch."
-    " Specifying 0 launches as many processes as CPU cores."
+    "Number of pages to download concurrently."
+    f" Specifying 0 launches {_default_num_threads} threads,"
+    " or as many processes as CPU cores with --cpu-bound."
 )
+# Workers run _fetch_as_json() of this module, so preload it along with the
+# scrapers which it only imports when the command runs
+_forkserver_preload = [
+    "pydantic",
+    "cldb.cli.fetch",
+    "cldb.models",
+    "cldb.nikon",
+    "cldb.sony",
+]
+_help_cpu_bound = "Fetch and parse pages in worker processes instead of threads."
 _help_lenses_csv = "The lens database file (source of already known equipment IDs)."
 _help_cameras_csv = "The camera database file (source of already known equipment IDs)."
 _help_output = "The file to store scraped spec data."
@@ -49,6 +74,7 @@ class FetchTarget(str, Enum):
 @click.option(
     "-j", "--num-workers", type=int, default=0, metavar="N", help=_help_num_workers
 )
+@click.option("--cpu-bound", is_flag=True, default=False, help=_help_cpu_bound)
 @click.option(
     "-o",
     "--output",
@@ -64,6 +90,7 @@ def fetch(
     lenses_csv: Path,
     cameras_csv: Path,
     num_workers: int,
+    cpu_bound: bool,
     verbose: int,
     output: Optional[Path],
 ) -> None:
@@ -71,6 +98,11 @@ def fetch(
 
     TARGET must be either 'camera' or 'lens'.
     """
+    # Import heavy modules here so that other subcommands start quickly
+    from joblib.parallel import delayed
+
+    from .. import models, nikon, sony, utils
+
     STR_COLUMNS = (models.KEY_LENS_BRAND, models.KEY_LENS_MOUNT, models.KEY_LENS_NAME)
     multiprocessing.freeze_support()
 
@@ -85,12 +117,13 @@ def fetch(
         _logger.info(f"fetching target: {target}")
         if target == FetchTarget.CAMERA:
             orig_data_path = cameras_csv
-            spec_source = itertools.chain(
+            spec_sources = [
                 sony.enum_cameras(sony.EquipmentType.NEW_CAMERA),
                 sony.enum_cameras(sony.EquipmentType.OLD_CAMERA),
                 nikon.enum_equipments(nikon.EquipmentType.SLR),
                 nikon.enum_equipments(nikon.EquipmentType.SLR_OLD),
-            )
+            ]
+            spec_type: Union[Type[models.Lens], Type[models.Camera]] = models.Camera
             sort_keys = [
                 models.KEY_CAMERA_BRAND,
                 models.KEY_CAMERA_MOUNT,
@@ -98,11 +131,12 @@ def fetch(
             ]
         elif target == FetchTarget.LENS:
             orig_data_path = lenses_csv
-            spec_source = itertools.chain(
+            spec_sources = [
                 nikon.enum_equipments(nikon.EquipmentType.F_LENS_OLD),
                 nikon.enum_equipments(nikon.EquipmentType.F_LENS),
                 nikon.enum_equipments(nikon.EquipmentType.Z_LENS),
-            )
+            ]
+            spec_type = models.Lens
             sort_keys = [
                 models.KEY_LENS_BRAND,
                 models.KEY_LENS_MOUNT,
@@ -113,26 +147,71 @@ def fetch(
         else:
             msg = f"unexpected fetch target: {target}"
             raise ValueError(msg)
+        fields = list(spec_type.__fields__)
 
         # Before fetching the newest data, load already assigned equipment IDs
-        orig_data = pd.read_csv(orig_data_path).set_index("Name")["ID"]
-        orig_id_map = {k.lower(): v.lower() for k, v in orig_data.to_dict().items()}
+        with open(orig_data_path, encoding="utf-8", newline="") as f:
+            orig_id_map = {
+                row["Name"].lower(): row["ID"].lower()
+                for row in csv.DictReader(f)
+                if row["ID"]
+            }
         _logger.info(
             f"number of already registered models: {len(orig_id_map)}"
             f" ({str(orig_data_path.absolute())})"
         )
 
-        # Collect where and how to fetch spec data for each equipment
-        name_uri_and_fetchers = list(spec_source)
-        total = len(name_uri_and_fetchers)
-        _logger.info(f"total number of equipment to fetch: {total}")
+        # Fetch and analyze equipment specs. The work is dominated by waiting
+        # for HTTP responses so it runs on threads unless told otherwise.
+        if cpu_bound:
+            # Fork worker processes from a server which has already imported
+            # the scraping modules, rather than spawning fresh interpreters
+            # which import them all over again
+            backend = "multiprocessing"
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                try:
+                    multiprocessing.set_start_method("forkserver")
+                except RuntimeError:
+                    pass  # already set
+                multiprocessing.set_forkserver_preload(_forkserver_preload)
+            prefer = "processes"
+            n_jobs = num_workers if 0 < num_workers else multiprocessing.cpu_count()
+        else:
+            backend = None
+            prefer = "threads"
+            n_jobs = num_workers if 0 < num_workers else _default_num_threads
 
-        # Fetch and analyze equipment specs
-        n_jobs = num_workers if 0 < num_workers else multiprocessing.cpu_count()
-        with utils.ProgressParallel(total=total, n_jobs=n_jobs) as parallel:
-            specs: Union[List[models.Lens], List[models.Camera]] = parallel(
-                delayed(f)(name, uri) for name, uri, f in name_uri_and_fetchers
+        # Each source downloads its own index page before yielding where and
+        # how to fetch spec data for each equipment, so the sources are consumed
+        # concurrently. Their items are still streamed into the workers in the
+        # order of the sources to keep the output stable between runs.
+        with ThreadPoolExecutor(max_workers=len(spec_sources)) as executor:
+            enumerated: Iterator[List[Tuple[str, str, SpecFetcher]]] = executor.map(
+                list, spec_sources
             )
+            name_uri_and_fetchers: Iterator[
+                Tuple[str, str, SpecFetcher]
+            ] = _unique_by_uri(itertools.chain.from_iterable(enumerated))
+            specs: List[Union[models.Lens, models.Camera]]
+            with utils.ProgressParallel(
+                total=None, n_jobs=n_jobs, backend=backend, prefer=prefer
+            ) as parallel:
+                if cpu_bound:
+                    # Let worker processes send back JSON text, which pickles as
+                    # a flat string, and rebuild the already validated models
+                    # without validating them again
+                    encoded_specs: List[str] = parallel(
+                        delayed(_fetch_as_json)(f, name, uri)
+                        for name, uri, f in name_uri_and_fetchers
+                    )
+                    specs = [
+                        spec_type.construct(**json.loads(s)) for s in encoded_specs
+                    ]
+                else:
+                    specs = parallel(
+                        delayed(f)(name, uri) for name, uri, f in name_uri_and_fetchers
+                    )
+        _logger.info(f"total number of fetched equipment: {len(specs)}")
 
         # Do some corrections such as:
         # - reuse already assigned IDs
@@ -152,23 +231,69 @@ def fetch(
         _logger.info(f"number of known models: {num_reused}")
         _logger.info(f"number of new models: {len(specs) - num_reused}")
 
-        # Sort the result
-        df = pd.DataFrame([s.dict() for s in specs]).sort_values(
-            by=sort_keys,
-            kind="mergesort",
-            key=lambda c: c.str.lower() if str(c) in STR_COLUMNS else c,
-        )
+        # Sort the result one key at a time, from the least significant key to
+        # the most significant one. Since list.sort() is stable, this yields the
+        # same order as sorting by all the keys at once. String keys are
+        # compared case-insensitively. Rows are plain tuples of attribute values
+        # which is cheaper than exporting each model with dict().
+        rows = [tuple(getattr(s, k) for k in fields) for s in specs]
+        for key in reversed(sort_keys):
+            index = fields.index(key)
+            if key in STR_COLUMNS:
+                rows.sort(key=lambda row: row[index].lower())
+            else:
+                rows.sort(key=itemgetter(index))
 
         # Now output it
-        write = partial(df.to_csv, index=None, float_format="%g")
+        def write(f: TextIO) -> None:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(fields)
+            writer.writerows([_format_cell(v) for v in row] for row in rows)
+
         if output is None:
             write(sys.stdout)
         else:
-            with open(output, "wb") as f:
-                write(f)
+            # Write to a temporary file first and then move it over the
+            # destination, so that the output (which may be the very database
+            # file the IDs were read from) is never left half-written
+            tmp_output = output.with_name(output.name + ".tmp")
+            try:
+                with open(tmp_output, "w", encoding="utf-8", newline="") as f:
+                    write(f)
+                os.replace(tmp_output, output)
+            except Exception:
+                try:
+                    tmp_output.unlink()
+                except FileNotFoundError:
+                    pass
+                raise
 
     except Exception:
         with io.StringIO() as buf:
             traceback.print_exc(file=buf)
             click.secho(str(buf.getvalue()), fg="red")
         ctx.exit(1)
+
+
+def _unique_by_uri(
+    items: Iterable[Tuple[str, str, SpecFetcher]]
+) -> Iterator[Tuple[str, str, SpecFetcher]]:
+    # Lineup pages may list the same product (e.g. a lens both on sale and
+    # discontinued), so skip a spec page which is already to be fetched
+    seen_uris: Set[str] = set()
+    for name, uri, fetcher in items:
+        if uri in seen_uris:
+            _logger.debug(f"skipped duplicate entry: {name} ({uri})")
+            continue
+        seen_uris.add(uri)
+        yield name, uri, fetcher
+
+
+def _fetch_as_json(fetcher: SpecFetcher, name: str, uri: str) -> str:
+    return fetcher(name, uri).json()
+
+
+def _format_cell(value: Any) -> Any:
+    # Format floats the same way as "%g" so that integral values such as focal
+    # lengths are written without a trailing ".0"
+    return format(value, "g") if isinstance(value, float) else value
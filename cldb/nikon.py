@@ -2,16 +2,17 @@ from __future__ import annotations
 
 import dataclasses
 import enum
+import functools
 import logging
 import re
-from typing import Dict, Iterator, List, Optional, Tuple, Union
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urljoin, urlparse
 from uuid import uuid4
 
-import bs4
 import pydantic
+from lxml import etree, html
 
-from . import SpecFetcher, config, models, utils
+from . import SpecFetcher, models, utils
 from .exceptions import CameraLensDatabaseException, ParseError
 
 _logger = logging.getLogger(__name__)
@@ -31,11 +32,12 @@ class Mount(str, enum.Enum):
     Z = "Nikon Z"
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def parse(s: str) -> Mount:
-        s = s.replace(" ", "")
-        if "ニコンZマウント" in s:
+        names = _re_mount_name.findall(s)
+        if "Z" in names:
             return Mount.Z
-        elif "ニコンFマウント" in s:
+        elif "F" in names:
             return Mount.F
         else:
             msg = f"unrecognizable mount description: {s}"
@@ -45,49 +47,92 @@ class Mount(str, enum.Enum):
 @dataclasses.dataclass
 class SpecParseParams(object):
     subpath: Optional[str]
-    table_selector: str
-    key_cell_selector: str
-    value_cell_selector: str
-
-
-_models_to_ignore = [
-    # Lenses
-    "AF-S TELECONVERTER TC-14E III",
-    "AF-S TELECONVERTER TC-20E III",
-    "AI AF-I Teleconverter TC-14E",
-    "AI AF-I Teleconverter TC-20E",
-    "AI AF-S TELECONVERTER TC-14E II",
-    "AI AF-S TELECONVERTER TC-17E II",
-    "AI AF-S TELECONVERTER TC-20E II",
-    "AI TC-14AS",
-    "AI TC-14BS",
-    "AI TC-201S",
-    "AI TC-301S",
-    "Z TELECONVERTER TC-1.4x",
-    "Z TELECONVERTER TC-2.0x",
-    # Cameras
-    "E3/E3S",
-    "F100",
-    "F5",
-    "F6",
-    "F80D/F80S",
-    "FM10",
-    "FM3A",
-    "Lite Touch Zoom 100W QD",
-    "Lite Touch Zoom 120ED QD",
-    "Lite Touch Zoom 130ED QD",
-    "Lite Touch Zoom 140ED QD",
-    "Lite Touch Zoom 150ED QD",
-    "Lite Touch Zoom 70Ws QD",
-    "NIKONOS-V",
-    "Nuvis S",
-    "Nuvis S2000",
-    "PRONEA S",
-    "S3 (限定復刻版)",
-    "U",
-    "U2",
-    "US",
+    table_path: etree.XPath
+    key_cell_path: etree.XPath
+    value_cell_path: etree.XPath
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# XPath equivalents of the CSS selectors used to scrape the pages, compiled once
+_xpath_goods_anchors = etree.XPath(f"//*[{_has_class('mod-goodsList-ul')}]/li/a")
+_xpath_goods_title = etree.XPath(f".//*[{_has_class('mod-goodsList-title')}]")
+_xpath_table = etree.XPath("//table")
+_xpath_table_a01 = etree.XPath(f"//table[{_has_class('table-A01-group')}]")
+# Only the first table following the anchor is used, so stop looking there
+_xpath_table_after_a_spec = etree.XPath("//a[@id='spec']/following-sibling::table[1]")
+_xpath_table_after_div_spec = etree.XPath(
+    "//div[@id='spec']/following-sibling::table[1]"
+)
+_xpath_rows = etree.XPath(".//tr")
+_xpath_th = etree.XPath(".//th")
+_xpath_td = etree.XPath(".//td")
+_xpath_first_td = etree.XPath(".//td[not(preceding-sibling::*)]")
+_xpath_last_td = etree.XPath(".//td[not(following-sibling::*)]")
+
+_re_mount_name = re.compile(r"ニコン\s*([ZF])\s*マウント")
+_re_full_width_parens = re.compile(r"（[^）]+）")
+_re_parens = re.compile(r"\([^\)]+\)")
+_re_bracketed_distance = re.compile(r"\[([\d\.m]+)\s*[：:]\s*[^\]]+\]")
+_re_name_suffix = re.compile(r"\s*(旧製品|＜NEW＞)$")
+_re_nikkor = re.compile(r"NIKKOR", re.IGNORECASE)
+_re_paren_without_space = re.compile(r"(?<=[^\s])\(")
+
+_lens_parse_params: List[SpecParseParams] = [
+    SpecParseParams(None, _xpath_table_a01, _xpath_th, _xpath_td),
+    SpecParseParams(None, _xpath_table_after_a_spec, _xpath_first_td, _xpath_last_td),
+    SpecParseParams("spec.html", _xpath_table_after_div_spec, _xpath_th, _xpath_td),
 ]
+_camera_parse_params: List[SpecParseParams] = [
+    SpecParseParams("spec.html", _xpath_table_after_div_spec, _xpath_th, _xpath_td),
+    SpecParseParams("spec.html", _xpath_table_a01, _xpath_th, _xpath_td),
+    SpecParseParams("spec.html", _xpath_table, _xpath_first_td, _xpath_last_td),
+]
+
+_lens_keys = frozenset(models.Lens.__fields__)
+
+_models_to_ignore: FrozenSet[str] = frozenset(
+    [
+        # Lenses
+        "AF-S TELECONVERTER TC-14E III",
+        "AF-S TELECONVERTER TC-20E III",
+        "AI AF-I Teleconverter TC-14E",
+        "AI AF-I Teleconverter TC-20E",
+        "AI AF-S TELECONVERTER TC-14E II",
+        "AI AF-S TELECONVERTER TC-17E II",
+        "AI AF-S TELECONVERTER TC-20E II",
+        "AI TC-14AS",
+        "AI TC-14BS",
+        "AI TC-201S",
+        "AI TC-301S",
+        "Z TELECONVERTER TC-1.4x",
+        "Z TELECONVERTER TC-2.0x",
+        # Cameras
+        "E3/E3S",
+        "F100",
+        "F5",
+        "F6",
+        "F80D/F80S",
+        "FM10",
+        "FM3A",
+        "Lite Touch Zoom 100W QD",
+        "Lite Touch Zoom 120ED QD",
+        "Lite Touch Zoom 130ED QD",
+        "Lite Touch Zoom 140ED QD",
+        "Lite Touch Zoom 150ED QD",
+        "Lite Touch Zoom 70Ws QD",
+        "NIKONOS-V",
+        "Nuvis S",
+        "Nuvis S2000",
+        "PRONEA S",
+        "S3 (限定復刻版)",
+        "U",
+        "U2",
+        "US",
+    ]
+)
 _known_lens_specs: Dict[str, Dict[str, Union[float, str]]] = {
     "AI AF Zoom-Nikkor 18-35mm f/3.5-4.5D IF-ED": {
         models.KEY_LENS_MIN_F_VALUE: 3.5,
@@ -114,10 +159,10 @@ def enum_equipments(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetch
     fetcher: SpecFetcher
     if target == EquipmentType.F_LENS_OLD:
         base_uri = "https://www.nikon-image.com/products/nikkor/discontinue_fmount/"
-        fetcher = fetch_lens
+        fetcher = fetch_f_lens
     elif target == EquipmentType.F_LENS:
         base_uri = "https://www.nikon-image.com/products/nikkor/fmount/index.html"
-        fetcher = fetch_lens
+        fetcher = fetch_f_lens
     elif target == EquipmentType.Z_LENS:
         base_uri = "https://www.nikon-image.com/products/nikkor/zmount/index.html"
         fetcher = fetch_lens
@@ -132,24 +177,24 @@ def enum_equipments(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetch
         raise ValueError(msg)
 
     html_text = utils.fetch(base_uri)
-    soup = bs4.BeautifulSoup(html_text, features=config["bs_features"])
-    for anchor in soup.select(".mod-goodsList-ul > li > a"):
+    tree = utils.parse_html_tree(html_text)
+    for anchor in _xpath_goods_anchors(tree):
         # Get the equipment name
-        name: str = anchor.select(".mod-goodsList-title")[0].text
+        name: str = _xpath_goods_title(anchor)[0].text_content()
         name = _normalize_name(name)
         if name in _models_to_ignore:
             continue
 
         # Get raw value of href attribute
-        raw_dest = anchor["href"]
-        if raw_dest.startswith("javascript:"):
+        raw_dest = anchor.get("href")
+        if raw_dest is None or raw_dest.startswith("javascript:"):
             continue
 
         # Check the destination looks fine
         pr = urlparse(raw_dest)
         if pr.hostname and pr.hostname != base_uri:
             msg = "skipped an item because it's not on the same server"
-            msg += f": {anchor['href']!r} <> {base_uri!r}"
+            msg += f": {raw_dest!r} <> {base_uri!r}"
             _logger.warning(msg)
             continue
 
@@ -160,17 +205,24 @@ def enum_equipments(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetch
         yield name, abs_dest, fetcher
 
 
-def fetch_lens(name: str, uri: str) -> models.Lens:
-    parse_params: List[SpecParseParams] = [
-        SpecParseParams(None, "table.table-A01-group", "th", "td"),
-        SpecParseParams(None, "a#spec ~ table", "td:first-child", "td:last-child"),
-        SpecParseParams("spec.html", "div#spec ~ table", "th", "td"),
-    ]
+def _load_page(
+    uri: str, subpath: Optional[str], trees: Dict[str, html.HtmlElement]
+) -> Tuple[str, html.HtmlElement]:
+    # Parse modes often read the same page, so fetch and parse each page once
+    # and share the tree between them
+    if subpath is not None:
+        uri = urljoin(uri, subpath)
+    if uri not in trees:
+        trees[uri] = utils.parse_html_tree(utils.fetch(uri))
+    return uri, trees[uri]
+
 
+def fetch_lens(name: str, uri: str, mount: Optional[Mount] = None) -> models.Lens:
+    trees: Dict[str, html.HtmlElement] = {}
     errors = []
-    for mode, params in enumerate(parse_params):
+    for mode, params in enumerate(_lens_parse_params):
         try:
-            return _fetch_lens(name, uri, params)
+            return _fetch_lens(name, uri, params, trees, mount)
         except ParseError as ex:
             errors.append((mode, ex))
 
@@ -180,13 +232,21 @@ def fetch_lens(name: str, uri: str) -> models.Lens:
     raise CameraLensDatabaseException("\n".join(msglines))
 
 
-def _fetch_lens(name: str, uri: str, pp: SpecParseParams) -> models.Lens:
-    if pp.subpath is not None:
-        uri = urljoin(uri, pp.subpath)
+def fetch_f_lens(name: str, uri: str) -> models.Lens:
+    # Lenses listed on the F mount lineup pages, of which spec tables may not
+    # tell the mount
+    return fetch_lens(name, uri, Mount.F)
 
-    html_text = utils.fetch(uri)
-    soup = bs4.BeautifulSoup(html_text, config["bs_features"])
-    selection = soup.select(pp.table_selector)
+
+def _fetch_lens(
+    name: str,
+    uri: str,
+    pp: SpecParseParams,
+    trees: Dict[str, html.HtmlElement],
+    mount: Optional[Mount],
+) -> models.Lens:
+    uri, tree = _load_page(uri, pp.subpath, trees)
+    selection = pp.table_path(tree)
     if len(selection) <= 0:
         msg = "spec table not found"
         raise ParseError(msg)
@@ -198,40 +258,31 @@ def _fetch_lens(name: str, uri: str, pp: SpecParseParams) -> models.Lens:
         models.KEY_LENS_BRAND: "Nikon",
         models.KEY_LENS_KEYWORDS: "",
     }
-    if "fmount/" in uri:
-        pairs[models.KEY_LENS_MOUNT] = Mount.F
+    if mount is not None:
+        pairs[models.KEY_LENS_MOUNT] = mount
 
     # Collect and parse interested th-td pairs from the spec table
-    spec_table: bs4.Tag = selection[0]
-    for row in spec_table.select("tr"):
-        key_cells: bs4.ResultSet = row.select(pp.key_cell_selector)
-        value_cells: bs4.ResultSet = row.select(pp.value_cell_selector)
+    spec_table: html.HtmlElement = selection[0]
+    for row in _xpath_rows(spec_table):
+        key_cells: List[html.HtmlElement] = pp.key_cell_path(row)
+        value_cells: List[html.HtmlElement] = pp.value_cell_path(row)
         if len(key_cells) != 1 or len(value_cells) != 1:
             msg = "spec table does not have 1 by 1 cell pairs"
             raise ParseError(msg)
 
-        key_cell_text = key_cells[0].text.strip()
-        value_cell_text = value_cells[0].text.strip()
-        for k, v in _recognize_lens_property(key_cell_text, value_cell_text).items():
-            pairs[k] = v
+        key_cell_text = key_cells[0].text_content().strip()
+        value_cell_text = value_cells[0].text_content().strip()
+        pairs.update(_recognize_lens_property(key_cell_text, value_cell_text))
 
     # Try extracting some specs from the model name
-    if (
-        models.KEY_LENS_MIN_FOCAL_LENGTH not in pairs
-        or models.KEY_LENS_MAX_FOCAL_LENGTH not in pairs
-    ):
-        for k, v in _recognize_lens_property("焦点距離", name).items():
-            pairs[k] = v
-    if models.KEY_LENS_MIN_F_VALUE not in pairs:
-        for k, v in _recognize_lens_property("最大絞り", name).items():
-            pairs[k] = v
+    for k, v in _recognize_lens_name(name).items():
+        pairs.setdefault(k, v)
 
     # Force using some spec data which is not available or hard to recognize
-    for k, v in _known_lens_specs.get(name, {}).items():
-        pairs[k] = v
+    pairs.update(_known_lens_specs.get(name, {}))
 
     # Skip if we couldn't get sufficient data
-    lacked_keys = set(models.Lens.__fields__.keys()).difference(pairs.keys())
+    lacked_keys = _lens_keys.difference(pairs)
     if lacked_keys:
         msg = f"cannot find {', '.join(lacked_keys)}"
         raise ParseError(msg)
@@ -244,64 +295,106 @@ def _fetch_lens(name: str, uri: str, pp: SpecParseParams) -> models.Lens:
 
 
 def _recognize_lens_property(key: str, value: str) -> Dict[str, Union[float, str]]:
-    if key == "型式":
-        mount = Mount.parse(value)
-        if mount is not None:
-            return {models.KEY_LENS_MOUNT: mount}
-    elif key == "焦点距離":
-        value = _remove_parens(value)
-        ranges = list(utils.enum_millimeter_ranges(value))
-        if ranges:
-            return {
-                models.KEY_LENS_MIN_FOCAL_LENGTH: min(n for n, _ in ranges),
-                models.KEY_LENS_MAX_FOCAL_LENGTH: max(n for _, n in ranges),
-            }
-    elif key == "最短撮影距離":
-        value = _remove_parens(value)
-        values = list(utils.enum_millimeter_values(value))
-        if values:
-            return {models.KEY_LENS_MIN_FOCUS_DISTANCE: min(values)}
-    elif key == "最小絞り":
-        values = list(utils.enum_f_numbers(value))
-        if values:
-            return {models.KEY_LENS_MAX_F_VALUE: max(values)}
-    elif key == "最大絞り":
-        values = list(utils.enum_f_numbers(value))
-        if values:
-            return {models.KEY_LENS_MIN_F_VALUE: min(values)}
+    recognize = _lens_property_recognizers.get(key)
+    return recognize(value) if recognize is not None else {}
+
+
+def _recognize_lens_mount(value: str) -> Dict[str, Union[float, str]]:
+    mount = Mount.parse(value)
+    if mount is not None:
+        return {models.KEY_LENS_MOUNT: mount}
+    return {}
+
+
+def _recognize_focal_length(value: str) -> Dict[str, Union[float, str]]:
+    value = _remove_parens(value)
+    min_focal_length = max_focal_length = None
+    for n1, n2 in utils.enum_millimeter_ranges(value):
+        if min_focal_length is None or n1 < min_focal_length:
+            min_focal_length = n1
+        if max_focal_length is None or max_focal_length < n2:
+            max_focal_length = n2
+    if min_focal_length is not None and max_focal_length is not None:
+        return {
+            models.KEY_LENS_MIN_FOCAL_LENGTH: min_focal_length,
+            models.KEY_LENS_MAX_FOCAL_LENGTH: max_focal_length,
+        }
+    return {}
+
+
+def _recognize_min_focus_distance(value: str) -> Dict[str, Union[float, str]]:
+    value = _remove_parens(value)
+    distance = min(utils.enum_millimeter_values(value), default=None)
+    if distance is not None:
+        return {models.KEY_LENS_MIN_FOCUS_DISTANCE: distance}
+    return {}
 
+
+def _recognize_max_f_value(value: str) -> Dict[str, Union[float, str]]:
+    f_value = max(utils.enum_f_numbers(value), default=None)
+    if f_value is not None:
+        return {models.KEY_LENS_MAX_F_VALUE: f_value}
     return {}
 
 
+def _recognize_min_f_value(value: str) -> Dict[str, Union[float, str]]:
+    f_value = min(utils.enum_f_numbers(value), default=None)
+    if f_value is not None:
+        return {models.KEY_LENS_MIN_F_VALUE: f_value}
+    return {}
+
+
+# Functions to recognize a lens property, looked up by a spec table header
+_lens_property_recognizers: Dict[str, utils.PropertyRecognizer] = {
+    "型式": _recognize_lens_mount,
+    "焦点距離": _recognize_focal_length,
+    "最短撮影距離": _recognize_min_focus_distance,
+    "最小絞り": _recognize_max_f_value,
+    "最大絞り": _recognize_min_f_value,
+}
+
+
+def _recognize_lens_name(name: str) -> Dict[str, Union[float, str]]:
+    # Model names often tell the focal length and the maximum aperture
+    return dict(_recognize_lens_name_items(name))
+
+
+@functools.lru_cache(maxsize=None)
+def _recognize_lens_name_items(name: str) -> Tuple[Tuple[str, Union[float, str]], ...]:
+    # The result is cached as it is needed again on each parse mode to try, and
+    # kept immutable so that no caller can alter what the others get
+    props = _recognize_lens_property("焦点距離", name)
+    props.update(_recognize_lens_property("最大絞り", name))
+    return tuple(props.items())
+
+
 def _remove_parens(s: str) -> str:
     s = utils.to_half_width(s)
-    s = re.sub(r"（[^）]+）", "", s)
-    s = re.sub(r"\([^\)]+\)", "", s)
-    s = re.sub(
-        r"\[([\d\.m]+)\s*[：:]\s*[^\]]+\]", r" \g<1>", s
-    )  # [0.21m：85mmマクロ時] --> 0.21m
+    if "（" in s:
+        s = _re_full_width_parens.sub("", s)
+    if "(" in s:
+        s = _re_parens.sub("", s)
+    if "[" in s:
+        s = _re_bracketed_distance.sub(r" \g<1>", s)  # [0.21m：85mmマクロ時] --> 0.21m
     return s
 
 
+@functools.lru_cache(maxsize=4096)
 def _normalize_name(name: str) -> str:
     name = utils.to_half_width(name)
-    name = re.sub(r"\s*(旧製品|＜NEW＞)$", "", name)
-    name = re.sub(r"NIKKOR", "Nikkor", name, re.IGNORECASE)
-    name = re.sub(r"(?<=[^\s])\(", " (", name)  # Insert space before an opening paren
+    name = _re_name_suffix.sub("", name)
+    name = _re_nikkor.sub("Nikkor", name)
+    # Insert space before an opening paren
+    name = _re_paren_without_space.sub(" (", name)
     return name
 
 
 def fetch_camera(name: str, uri: str) -> models.Camera:
-    parse_params: List[SpecParseParams] = [
-        SpecParseParams("spec.html", "div#spec ~ table", "th", "td"),
-        SpecParseParams("spec.html", "table.table-A01-group", "th", "td"),
-        SpecParseParams("spec.html", "table", "td:first-child", "td:last-child"),
-    ]
-
+    trees: Dict[str, html.HtmlElement] = {}
     errors = []
-    for mode, params in enumerate(parse_params):
+    for mode, params in enumerate(_camera_parse_params):
         try:
-            return _fetch_camera(name, uri, params)
+            return _fetch_camera(name, uri, params, trees)
         except ParseError as ex:
             errors.append((mode, ex))
 
@@ -311,13 +404,11 @@ def fetch_camera(name: str, uri: str) -> models.Camera:
     raise CameraLensDatabaseException("\n".join(msglines))
 
 
-def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
-    if pp.subpath is not None:
-        uri = urljoin(uri, pp.subpath)
-
-    html_text = utils.fetch(uri)
-    soup = bs4.BeautifulSoup(html_text, config["bs_features"])
-    selection = soup.select(pp.table_selector)
+def _fetch_camera(
+    name: str, uri: str, pp: SpecParseParams, trees: Dict[str, html.HtmlElement]
+) -> models.Camera:
+    uri, tree = _load_page(uri, pp.subpath, trees)
+    selection = pp.table_path(tree)
     if len(selection) <= 0:
         msg = f"spec table not found: {uri}"
         raise ParseError(msg)
@@ -331,21 +422,19 @@ def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
     }
 
     # Collect and parse interested th-td pairs from the spec table
-    spec_table: bs4.Tag = selection[0]
-    for row in spec_table.select("tr"):
-        key_cells: bs4.ResultSet = row.select(pp.key_cell_selector)
-        value_cells: bs4.ResultSet = row.select(pp.value_cell_selector)
+    spec_table: html.HtmlElement = selection[0]
+    for row in _xpath_rows(spec_table):
+        key_cells: List[html.HtmlElement] = pp.key_cell_path(row)
+        value_cells: List[html.HtmlElement] = pp.value_cell_path(row)
         if len(key_cells) != 1 or len(value_cells) != 1:
             continue
 
-        key_cell_text = key_cells[0].text.strip()
-        value_cell_text = value_cells[0].text.strip()
-        for k, v in _recognize_camera_property(key_cell_text, value_cell_text).items():
-            pairs[k] = v
+        key_cell_text = key_cells[0].text_content().strip()
+        value_cell_text = value_cells[0].text_content().strip()
+        pairs.update(_recognize_camera_property(key_cell_text, value_cell_text))
 
     # Force using some spec data which is not available or hard to recognize
-    for k, v in _known_camera_specs.get(name, {}).items():
-        pairs[k] = v
+    pairs.update(_known_camera_specs.get(name, {}))
 
     # Infer media size name if not set
     if models.KEY_CAMERA_SIZE_NAME not in pairs:
@@ -366,21 +455,21 @@ def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
 
 
 def _recognize_camera_property(key: str, value: str) -> Dict[str, Union[float, str]]:
-    if key == "レンズマウント":
-        mount = Mount.parse(value)
-        if mount is not None:
-            return {models.KEY_CAMERA_MOUNT: mount}
+    recognize = _camera_property_recognizers.get(key)
+    return recognize(value) if recognize is not None else {}
 
-    elif key in ("撮像素子", "撮像素子方式", "方式"):
-        props: Dict[str, Union[float, str]] = {}
 
-        areas = list(utils.enum_square_millimeters(value))
-        if len(areas) == 1:
-            w, h = areas[0]
-            props[models.KEY_CAMERA_MEDIA_WIDTH] = w
-            props[models.KEY_CAMERA_MEDIA_HEIGHT] = h
+def _recognize_camera_mount(value: str) -> Dict[str, Union[float, str]]:
+    mount = Mount.parse(value)
+    if mount is not None:
+        return {models.KEY_CAMERA_MOUNT: mount}
+    return {}
 
-        if props:
-            return props
 
-    return {}
+# Functions to recognize a camera property, looked up by a spec table header
+_camera_property_recognizers: Dict[str, utils.PropertyRecognizer] = {
+    "レンズマウント": _recognize_camera_mount,
+    "撮像素子": utils.recognize_media_size,
+    "撮像素子方式": utils.recognize_media_size,
+    "方式": utils.recognize_media_size,
+}
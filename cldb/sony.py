@@ -3,15 +3,15 @@ from __future__ import annotations
 import dataclasses
 import enum
 import logging
-import re
-from typing import Dict, Iterator, List, Optional, Tuple, Union
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urljoin, urlparse
 from uuid import uuid4
 
 import bs4
 import pydantic
+import soupsieve
 
-from . import SpecFetcher, config, models, utils
+from . import SpecFetcher, models, utils
 from .exceptions import CameraLensDatabaseException, ParseError
 
 _logger = logging.getLogger(__name__)
@@ -41,12 +41,42 @@ class Mount(str, enum.Enum):
 @dataclasses.dataclass
 class SpecParseParams(object):
     subpath: Optional[str]
-    table_selector: str
-    key_cell_selector: str
-    value_cell_selector: str
-
-
-_models_to_ignore: List[str] = []
+    table_strainer: bs4.SoupStrainer
+    table_selector: soupsieve.SoupSieve
+    key_cell_selector: soupsieve.SoupSieve
+    value_cell_selector: soupsieve.SoupSieve
+
+
+# Only the elements enclosing the interested parts of the pages are parsed
+_strainer_lineup_items = bs4.SoupStrainer("div", attrs={"data-s5lineup-pid": True})
+_strainer_s5_spec_table = bs4.SoupStrainer(class_="s5-specTable")
+_strainer_mod_spec_table = bs4.SoupStrainer(class_="mod-specTable")
+
+# CSS selectors, compiled once
+_css_lineup_item = soupsieve.compile("div[data-s5lineup-pid]")
+_css_lineup_model_name = soupsieve.compile(".s5-listItem4__modelName")
+_css_lineup_main_link = soupsieve.compile(".s5-listItem4__mainLink")
+_css_s5_spec_table = soupsieve.compile(".s5-specTable > table")
+_css_mod_spec_table = soupsieve.compile(".mod-specTable")
+_css_th = soupsieve.compile("th")
+_css_td = soupsieve.compile("td")
+_css_table_th = soupsieve.compile("table th")
+_css_table_td_after_th = soupsieve.compile("table th ~ td")
+
+_camera_parse_params: List[SpecParseParams] = [
+    SpecParseParams(
+        "spec.html", _strainer_s5_spec_table, _css_s5_spec_table, _css_th, _css_td
+    ),
+    SpecParseParams(
+        "spec.html",
+        _strainer_mod_spec_table,
+        _css_mod_spec_table,
+        _css_table_th,
+        _css_table_td_after_th,
+    ),
+]
+
+_models_to_ignore: FrozenSet[str] = frozenset()
 _known_lens_specs: Dict[str, Dict[str, Union[float, str]]] = {}
 _known_camera_specs: Dict[str, Dict[str, Union[float, str]]] = {
     "DSLR-A900": {models.KEY_CAMERA_MOUNT: Mount.A},
@@ -54,13 +84,13 @@ _known_camera_specs: Dict[str, Dict[str, Union[float, str]]] = {
 
 
 def enum_cameras(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetcher]]:
-    card: bs4.ResultSet
+    card: bs4.Tag
 
     if target == EquipmentType.NEW_CAMERA:
         base_uri = "https://www.sony.jp/ichigan/lineup/"
-        item_selector = "div[data-s5lineup-pid]"
-        name_selector = ".s5-listItem4__modelName"
-        anchor_selector = ".s5-listItem4__mainLink"
+        item_selector = _css_lineup_item
+        name_selector = _css_lineup_model_name
+        anchor_selector = _css_lineup_main_link
     elif target == EquipmentType.OLD_CAMERA:
         # TODO: Generalize the pattern using JSONP with HTML scraping
         import json
@@ -68,7 +98,10 @@ def enum_cameras(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetcher]
         base_uri = "https://www.sony.jp/ichigan/lineup/past.html"
         jsonp_uri = "https://www.sony.jp/webapi/past_product/previous_product.php?callback=PreviousProduct&categoryId=2508,3729,4588&startDate=20010101&flag=3&sort=2"  # noqa: E501
         html_text = utils.fetch(jsonp_uri)
-        obj = json.loads(re.findall(r"PreviousProduct\((.*)\)", html_text)[0])
+        # Unwrap the JSONP callback, of which name is specified in the URI
+        start = html_text.index("PreviousProduct(") + len("PreviousProduct(")
+        end = html_text.rindex(")")
+        obj = json.loads(html_text[start:end])
         eval_name = lambda obj: [x["modelName"] for x in obj["product"]]
         eval_href = lambda obj: [x["productLink"] for x in obj["product"]]
         for name, href in zip(eval_name(obj), eval_href(obj)):
@@ -79,10 +112,10 @@ def enum_cameras(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetcher]
         raise ValueError(msg)
 
     html_text = utils.fetch(base_uri)
-    soup = bs4.BeautifulSoup(html_text, features=config["bs_features"])
-    for card in soup.select(item_selector):
-        name = card.select(name_selector)[0].text.strip()
-        anchor = card.select(anchor_selector)[0]
+    soup = utils.parse_html(html_text, parse_only=_strainer_lineup_items)
+    for card in item_selector.select(soup):
+        name = name_selector.select(card)[0].text.strip()
+        anchor = anchor_selector.select(card)[0]
 
         # Get raw value of href attribute
         raw_dest = anchor["href"]
@@ -105,15 +138,11 @@ def enum_cameras(target: EquipmentType) -> Iterator[Tuple[str, str, SpecFetcher]
 
 
 def fetch_camera(name: str, uri: str) -> models.Camera:
-    parse_params: List[SpecParseParams] = [
-        SpecParseParams("spec.html", ".s5-specTable > table", "th", "td"),
-        SpecParseParams("spec.html", ".mod-specTable", "table th", "table th ~ td"),
-    ]
-
+    pages: Dict[str, str] = {}
     errors = []
-    for idx, params in enumerate(parse_params):
+    for idx, params in enumerate(_camera_parse_params):
         try:
-            return _fetch_camera(name, uri, params)
+            return _fetch_camera(name, uri, params, pages)
         except ParseError as ex:
             errors.append((idx, ex))
 
@@ -123,13 +152,19 @@ def fetch_camera(name: str, uri: str) -> models.Camera:
     raise CameraLensDatabaseException("\n".join(msglines))
 
 
-def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
+def _fetch_camera(
+    name: str, uri: str, pp: SpecParseParams, pages: Dict[str, str]
+) -> models.Camera:
     if pp.subpath is not None:
         uri = urljoin(uri, pp.subpath)
 
-    html_text = utils.fetch(uri)
-    soup = bs4.BeautifulSoup(html_text, config["bs_features"])
-    selection = soup.select(pp.table_selector)
+    # Parse modes often read the same page but parse different parts of it,
+    # so fetch each page once and share the text between them
+    if uri not in pages:
+        pages[uri] = utils.fetch(uri)
+    html_text = pages[uri]
+    soup = utils.parse_html(html_text, parse_only=pp.table_strainer)
+    selection = pp.table_selector.select(soup)
     if len(selection) <= 0:
         msg = f"spec table not found: {uri}"
         raise ParseError(msg)
@@ -144,20 +179,18 @@ def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
 
     # Collect and parse interested th-td pairs from the spec table
     spec_table: bs4.Tag = selection[0]
-    for row in spec_table.select("tr"):
-        key_cells: bs4.ResultSet = row.select(pp.key_cell_selector)
-        value_cells: bs4.ResultSet = row.select(pp.value_cell_selector)
+    for row in spec_table.find_all("tr"):
+        key_cells: List[bs4.Tag] = pp.key_cell_selector.select(row)
+        value_cells: List[bs4.Tag] = pp.value_cell_selector.select(row)
         if len(key_cells) != 1 or len(value_cells) != 1:
             continue
 
         key_cell_text = key_cells[0].text.strip()
         value_cell_text = value_cells[0].text.strip()
-        for k, v in _recognize_camera_property(key_cell_text, value_cell_text).items():
-            pairs[k] = v
+        pairs.update(_recognize_camera_property(key_cell_text, value_cell_text))
 
     # Force using some spec data which is not available or hard to recognize
-    for k, v in _known_camera_specs.get(name, {}).items():
-        pairs[k] = v
+    pairs.update(_known_camera_specs.get(name, {}))
 
     # Infer media size name if not set
     if models.KEY_CAMERA_SIZE_NAME not in pairs:
@@ -178,22 +211,21 @@ def _fetch_camera(name: str, uri: str, pp: SpecParseParams) -> models.Camera:
 
 
 def _recognize_camera_property(key: str, value: str) -> Dict[str, Union[float, str]]:
-    # TODO: This can be merged with nikon._recognize_camera_prop... as a static dict?
-    if key in ("レンズマウント", "使用レンズ"):
-        mount = Mount.parse(value)
-        if mount is not None:
-            return {models.KEY_CAMERA_MOUNT: mount}
+    recognize = _camera_property_recognizers.get(key)
+    return recognize(value) if recognize is not None else {}
 
-    elif key == "撮像素子":
-        props: Dict[str, Union[float, str]] = {}
 
-        areas = list(utils.enum_square_millimeters(value))
-        if len(areas) == 1:
-            w, h = areas[0]
-            props[models.KEY_CAMERA_MEDIA_WIDTH] = w
-            props[models.KEY_CAMERA_MEDIA_HEIGHT] = h
+def _recognize_camera_mount(value: str) -> Dict[str, Union[float, str]]:
+    mount = Mount.parse(value)
+    if mount is not None:
+        return {models.KEY_CAMERA_MOUNT: mount}
+    return {}
 
-        if props:
-            return props
 
-    return {}
+# Sony spec tables name some rows differently from Nikon's, and mounts are of
+# this module's Mount, so the headers are mapped here
+_camera_property_recognizers: Dict[str, utils.PropertyRecognizer] = {
+    "レンズマウント": _recognize_camera_mount,
+    "使用レンズ": _recognize_camera_mount,
+    "撮像素子": utils.recognize_media_size,
+}
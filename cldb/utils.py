@@ -1,74 +1,202 @@
+import codecs
+import functools
+import json
 import re
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
 from hashlib import sha256
-from typing import Any, Iterator, List, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type, Union
 
+import bs4
+import lxml.etree
+import lxml.html
 import requests
 import tqdm.auto
 from joblib import Parallel
+from requests.adapters import HTTPAdapter, Retry
 
-from . import cache_root, models
+from . import config, get_cache_root, models
+from .exceptions import ParseError
 
 CACHE_TIMEOUT = 8 * 3600
+ERROR_CACHE_TIMEOUT = 3600
+HTTP_TIMEOUT = (5.0, 30.0)  # for connecting and reading respectively
 
+# Conditional request headers and the response headers providing their values
+_cache_validators = {
+    "If-None-Match": "ETag",
+    "If-Modified-Since": "Last-Modified",
+}
+
+# A function to recognize spec properties from a value in a spec table
+PropertyRecognizer = Callable[[str], Dict[str, Union[float, str]]]
+
+# HTTP sessions and HTML parsers, one per thread as they are not thread safe
+_local = threading.local()
+
+_re_millimeter_range_or_value = re.compile(
+    r"([\d\.]+)(?:mm)?\s*-\s*([\d\.]+)mm|([\d\.]+)mm"
+)
+_re_length = re.compile(r"([\d\.]+)\s*(mm?)")
 _re_square_millimeter = re.compile(
     r"([\d\.]+)(?:\(H\))?\s*[×x]\s*([\d\.]+)(?:\(V\))?\s*mm"
 )
+_re_f_number_or_number = re.compile(r"f/([\d\.]+)|([\d\.]+)(?![m\d])")
+_re_full_width_parens = re.compile(r"（([^）]+)）")
+_re_wave_dash_range = re.compile(r"(?<=\d)～(?=[\dF])")
 
 
 class ProgressParallel(Parallel):  # type: ignore[misc]
     # https://stackoverflow.com/questions/37804279/how-can-we-use-tqdm-in-a-parallel-execution-with-joblib
-    def __init__(self, total: int, *args: Any, **kwargs: Any):
+    def __init__(self, total: Optional[int], *args: Any, **kwargs: Any):
         super().__init__(*args, **kwargs)
         self._total = total
 
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
-        with tqdm.auto.tqdm() as self._pbar:
+        # Show progress only on a terminal, and redraw it at most twice a second
+        disable = not sys.stderr.isatty()
+        with tqdm.auto.tqdm(disable=disable, mininterval=0.5) as self._pbar:
             return Parallel.__call__(self, *args, **kwargs)
 
     def print_progress(self) -> None:
-        self._pbar.total = self._total
-        self._pbar.n = self.n_completed_tasks
-        self._pbar.refresh()
+        # If the number of tasks is not known in advance (i.e. tasks are
+        # streamed from a generator), show the number dispatched so far
+        if self._total is not None:
+            self._pbar.total = self._total
+        else:
+            self._pbar.total = self.n_dispatched_tasks
+        self._pbar.update(self.n_completed_tasks - self._pbar.n)
 
 
-def fetch(uri: str) -> str:
-    # Ensure the cache dir exists
-    cache_root.mkdir(parents=True, exist_ok=True)
+def _get_session() -> requests.Session:
+    # Reuse connections (and TLS sessions) to the same host across requests
+    session: Optional[requests.Session] = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.2))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
 
+def _is_utf8(encoding: Optional[str]) -> bool:
+    if encoding is None:
+        return False
+    try:
+        return codecs.lookup(encoding).name == "utf-8"
+    except LookupError:
+        return False  # unknown to Python; leave it to requests to decode
+
+
+def fetch(uri: str) -> str:
     # Return cached data if its not so old
+    cache_root = get_cache_root()
     uri_bytes = uri.encode("utf-8", errors="replace")
     uri_hash = sha256(uri_bytes)
     cache_file_path = (cache_root / uri_hash.hexdigest()).with_suffix(".html")
-    if cache_file_path.is_file():
-        cached_time = datetime.utcfromtimestamp(cache_file_path.stat().st_mtime)
-        if datetime.utcnow() < cached_time + timedelta(seconds=CACHE_TIMEOUT):
-            return cache_file_path.read_text("utf-8", errors="strict")
+    validators_path = cache_file_path.with_suffix(".json")
+    validators: Dict[str, Any] = {}
+    try:
+        cached_time: Optional[float] = cache_file_path.stat().st_mtime
+    except FileNotFoundError:
+        cached_time = None
+    if cached_time is not None:
+        try:
+            validators = json.loads(validators_path.read_text("utf-8"))
+        except FileNotFoundError:
+            pass
+        # Error responses (e.g. 404 for a discontinued product) are kept only
+        # briefly so that a page which comes back is noticed soon
+        if validators.get("status", 200) < 400:
+            timeout = CACHE_TIMEOUT
+        else:
+            timeout = ERROR_CACHE_TIMEOUT
+        if time.time() - cached_time < timeout:
+            return cache_file_path.read_bytes().decode("utf-8", errors="replace")
+
+    # Otherwise, download the resource unless the server says the cached one
+    # is still valid
+    headers = {}
+    for request_header, response_header in _cache_validators.items():
+        if response_header in validators:
+            headers[request_header] = validators[response_header]
+    resp = _get_session().get(uri, headers=headers, timeout=HTTP_TIMEOUT)
+    if resp.status_code == 304:
+        cache_file_path.touch()
+        return cache_file_path.read_bytes().decode("utf-8", errors="replace")
+
+    # Ensure the cache dir exists, which matters only when storing a response
+    cache_root.mkdir(parents=True, exist_ok=True)
 
-    # Otherwise, download the resource
-    resp = requests.get(uri)
-    cache_file_path.write_text(resp.text, encoding="utf-8", errors="replace")
-    return resp.text
+    # Store UTF-8 content as is; other encodings are converted to UTF-8 first
+    if _is_utf8(resp.encoding):
+        content = resp.content
+        text = content.decode("utf-8", errors="replace")
+    else:
+        text = resp.text
+        content = text.encode("utf-8", errors="replace")
+    cache_file_path.write_bytes(content)
+    validators = {
+        k: resp.headers[k] for k in _cache_validators.values() if k in resp.headers
+    }
+    validators["status"] = resp.status_code
+    validators_path.write_text(json.dumps(validators), encoding="utf-8")
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_tree_builder(features: str) -> Type[bs4.builder.TreeBuilder]:
+    builder = bs4.builder.builder_registry.lookup(features)
+    if builder is None:
+        raise bs4.FeatureNotFound(f"no tree builder supports {features!r}")
+    return builder
+
+
+def parse_html(
+    html_text: str, parse_only: Optional[bs4.SoupStrainer] = None
+) -> bs4.BeautifulSoup:
+    # Resolve the tree builder once instead of on every BeautifulSoup() call.
+    # The class (not an instance) is passed so that each call gets its own
+    # builder and parsing stays thread safe.
+    builder = _lookup_tree_builder(config["bs_features"])
+    return bs4.BeautifulSoup(html_text, builder=builder, parse_only=parse_only)
+
+
+def _get_html_parser() -> lxml.html.HTMLParser:
+    # Reuse a parser per thread as lxml parsers must not be shared between
+    # threads. Elements are never looked up by ID, so skip indexing them.
+    parser: Optional[lxml.html.HTMLParser] = getattr(_local, "html_parser", None)
+    if parser is None:
+        parser = lxml.html.HTMLParser(encoding="utf-8", collect_ids=False)
+        _local.html_parser = parser
+    return parser
+
+
+def parse_html_tree(html_text: str) -> lxml.html.HtmlElement:
+    # Feed UTF-8 bytes rather than str, which lxml rejects if it starts with an
+    # XML declaration specifying an encoding
+    try:
+        html_bytes = html_text.encode("utf-8", errors="replace")
+        return lxml.html.document_fromstring(html_bytes, parser=_get_html_parser())
+    except (lxml.etree.ParserError, ValueError) as ex:
+        raise ParseError(f"cannot parse HTML: {ex}") from ex
 
 
 def enum_millimeter_ranges(s: str) -> Iterator[Tuple[float, float]]:
-    pairs = [
-        (float(n1), float(n2))
-        for n1, n2 in re.findall(r"([\d\.]+)(?:mm)?\s*-\s*([\d\.]+)mm", s)
-    ]
+    # Find ranges and single values in one scan
+    matches = _re_millimeter_range_or_value.findall(s)
+    pairs = [(float(n1), float(n2)) for n1, n2, n in matches if not n]
     if pairs:
-        for n1, n2 in pairs:
-            yield n1, n2
+        yield from pairs
         return  # do not try extracting single value if a range found
 
-    singles = [float(n) for n in re.findall(r"([\d\.]+)mm", s)]
-    if singles:
-        for n in singles:
-            yield n, n
+    for _, _, n in matches:
+        yield float(n), float(n)
 
 
 def enum_millimeter_values(s: str) -> Iterator[float]:
-    for number, unit in re.findall(r"([\d\.]+)\s*(mm?)", s):
+    for number, unit in _re_length.findall(s):
         if unit == "mm":
             ratio = 1.0
         elif unit == "m":
@@ -87,15 +215,17 @@ def enum_square_millimeters(s: str) -> Iterator[Tuple[float, float]]:
 
 
 def enum_f_numbers(s: str) -> Iterator[float]:
-    f_numbers = re.findall(r"f/([\d\.]+)", s)
-    if f_numbers:
-        for number in f_numbers:
-            yield float(number)
+    # Numbers written as "f/N" and bare ones are found in one scan
+    for f_number, number in _re_f_number_or_number.findall(s):
+        yield float(f_number or number)
+
 
-    numbers = re.findall(r"([\d\.]+)(?![m\d])", s)
-    if numbers:
-        for number in numbers:
-            yield float(number)
+def recognize_media_size(value: str) -> Dict[str, Union[float, str]]:
+    areas = list(enum_square_millimeters(value))
+    if len(areas) == 1:
+        w, h = areas[0]
+        return {models.KEY_CAMERA_MEDIA_WIDTH: w, models.KEY_CAMERA_MEDIA_HEIGHT: h}
+    return {}
 
 
 def infer_keywords(model: Union[models.Lens, models.Camera]) -> List[str]:
@@ -108,7 +238,11 @@ def infer_keywords(model: Union[models.Lens, models.Camera]) -> List[str]:
     return keywords
 
 
+@functools.lru_cache(maxsize=4096)
 def to_half_width(s: str) -> str:
-    s = re.sub(r"（([^）]+)）", r"(\g<1>)", s)
-    s = re.sub(r"(?<=\d)～(?=[\dF])", "-", s)
+    # Run the regular expressions only if the characters to replace are there
+    if "（" in s:
+        s = _re_full_width_parens.sub(r"(\g<1>)", s)
+    if "～" in s:
+        s = _re_wave_dash_range.sub("-", s)
     return s
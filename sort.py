@@ -1,6 +1,22 @@
 """Script to sort cameras.csv and lenses.csv."""
+from typing import List
+
 import pandas as pd
 
+
+def _stable_multisort(df: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+    # Sort one column at a time, from the least significant key to the most
+    # significant one. Since mergesort is stable, this yields the same order as
+    # sorting by all the keys at once. String columns are compared
+    # case-insensitively, using lower-cased copies which are made only once and
+    # sorted along with the data as hidden columns.
+    str_cols = [col for col in by if pd.api.types.is_string_dtype(df[col])]
+    df = df.assign(**{"_" + col: df[col].str.lower() for col in str_cols})
+    for col in reversed(by):
+        df = df.sort_values("_" + col if col in str_cols else col, kind="mergesort")
+    return df.drop(columns=["_" + col for col in str_cols])
+
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
@@ -9,25 +25,20 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     cameras = pd.read_csv("cameras.csv")
-    cameras = cameras.sort_values(
-        by=["Brand", "Mount", "Name"],
-        kind="mergesort",
-        key=lambda col: col.str.lower() if pd.api.types.is_string_dtype(col) else col,
-    )
+    cameras = _stable_multisort(cameras, ["Brand", "Mount", "Name"])
     filename = "cameras.csv" if args.overwrite else "cameras.sorted.csv"
     cameras.to_csv(filename, index=None, float_format="%g")
 
     lenses = pd.read_csv("lenses.csv")
-    lenses = lenses.sort_values(
-        by=[
+    lenses = _stable_multisort(
+        lenses,
+        [
             "Brand",
             "Mount",
             "Min. Focal Length (mm)",
             "Max. Focal Length (mm)",
             "Name",
         ],
-        kind="mergesort",
-        key=lambda col: col.str.lower() if pd.api.types.is_string_dtype(col) else col,
     )
     filename = "lenses.csv" if args.overwrite else "lenses.sorted.csv"
     lenses.to_csv(filename, index=None, float_format="%g")
@@ -0,0 +1,16 @@
+import pytest
+
+import cldb.nikon
+
+
+@pytest.mark.parametrize(
+    "name, want",
+    [
+        ("nikkor", "Nikkor"),
+        ("AF-S NIKKOR 50mm f/1.8G", "AF-S Nikkor 50mm f/1.8G"),
+        ("AI AF Zoom-nikkor 35mm f/2D", "AI AF Zoom-Nikkor 35mm f/2D"),
+        ("NIKKOR Z 50mm f/1.8 S 旧製品", "Nikkor Z 50mm f/1.8 S"),
+    ],
+)
+def test_normalize_name(name, want):
+    assert cldb.nikon._normalize_name(name) == want
@@ -1,3 +1,5 @@
+import os
+import time
 from math import isclose
 
 import pytest
@@ -20,3 +22,115 @@ def test_enum_square_millimeters(s, want):
     area = got[0]
     assert isclose(area[0], want[0])
     assert isclose(area[1], want[1])
+
+
+@pytest.mark.parametrize(
+    "s, want",
+    [
+        ("24-70mm", [(24, 70)]),
+        ("24mm-70mm", [(24, 70)]),
+        ("18 - 55mm", [(18, 55)]),
+        ("10.5-24mm 35mm", [(10.5, 24)]),
+        ("50mm", [(50, 50)]),
+        ("0.45m (0.3mm)", [(0.3, 0.3)]),
+        ("２４mm", [(24, 24)]),
+        (cldb.utils.to_half_width("24～70mm"), [(24, 70)]),
+        ("焦点距離なし", []),
+        ("", []),
+    ],
+)
+def test_enum_millimeter_ranges(s, want):
+    assert list(cldb.utils.enum_millimeter_ranges(s)) == want
+
+
+@pytest.mark.parametrize(
+    "s, want",
+    [
+        ("f/1.8", [1.8]),
+        ("16", [16]),
+        ("f/22-27", [22, 27]),
+        ("50mm f/1.4", [1.4]),
+        ("1：2.8", [1, 2.8]),
+        (cldb.utils.to_half_width("f/3.5～4.5"), [3.5, 4.5]),
+        ("f値なし", []),
+        ("", []),
+    ],
+)
+def test_enum_f_numbers(s, want):
+    assert list(cldb.utils.enum_f_numbers(s)) == want
+
+
+class _FakeResponse:
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.encoding = "utf-8"
+        self.headers = headers or {}
+
+
+class _FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, uri, headers, timeout):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def cache_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(cldb.utils, "get_cache_root", lambda: tmp_path)
+    return tmp_path
+
+
+def _use_session(monkeypatch, session):
+    monkeypatch.setattr(cldb.utils._local, "session", session, raising=False)
+
+
+def _age_cache(cache_root, seconds):
+    t = time.time() - seconds
+    for path in cache_root.iterdir():
+        os.utime(path, (t, t))
+
+
+def test_fetch_fresh_cache(cache_root, monkeypatch):
+    session = _FakeSession(_FakeResponse(200, "<html>1</html>"))
+    _use_session(monkeypatch, session)
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+    assert len(session.requests) == 1
+
+
+def test_fetch_revalidate(cache_root, monkeypatch):
+    session = _FakeSession(
+        _FakeResponse(200, "<html>1</html>", {"ETag": '"abc"'}),
+        _FakeResponse(304),
+    )
+    _use_session(monkeypatch, session)
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+
+    # A stale entry is revalidated and then served as fresh again
+    _age_cache(cache_root, cldb.utils.CACHE_TIMEOUT + 1)
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+    assert session.requests[1] == {"If-None-Match": '"abc"'}
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+    assert len(session.requests) == 2
+
+
+def test_fetch_error_cache_timeout(cache_root, monkeypatch):
+    session = _FakeSession(
+        _FakeResponse(404, "not found"),
+        _FakeResponse(200, "<html>1</html>"),
+    )
+    _use_session(monkeypatch, session)
+    assert cldb.utils.fetch("https://example.com/") == "not found"
+
+    _age_cache(cache_root, cldb.utils.ERROR_CACHE_TIMEOUT - 60)
+    assert cldb.utils.fetch("https://example.com/") == "not found"
+    assert len(session.requests) == 1
+
+    _age_cache(cache_root, cldb.utils.ERROR_CACHE_TIMEOUT + 1)
+    assert cldb.utils.fetch("https://example.com/") == "<html>1</html>"
+    assert len(session.requests) == 2